@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Optional
+
+# Validated Tinify API keys are trusted for this many seconds
+TINIFY_KEY_TTL = 24 * 60 * 60
+# Oldest images are evicted once the image cache stores more bytes than this
+IMAGE_CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+
+def get_cache_dir() -> Path:
+    """
+    Get the folder where epub-image-optimizer keeps its cache files.
+    Honors XDG_CACHE_HOME, defaults to "~/.cache/epub_image_optimizer".
+
+    Returns:
+        Path: Cache folder, it may not exist yet
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path(Path.home(), ".cache")
+    return Path(cache_home, "epub_image_optimizer")
+
+
+def _get_tinify_keys_file() -> Path:
+    """Path of the file storing validated Tinify API keys"""
+    return Path(get_cache_dir(), "tinify_keys.json")
+
+
+def _hash_tinify_key(api_key: str) -> str:
+    """Hash of the Tinify API key, the key itself is never stored"""
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+def _load_tinify_keys() -> dict:
+    """Load the validated Tinify API key hashes that haven't expired yet"""
+    try:
+        with open(_get_tinify_keys_file(), encoding="utf-8") as keys_file:
+            validated_keys = json.load(keys_file)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(validated_keys, dict):
+        return {}
+    now = time.time()
+    return {
+        key_hash: validated_at
+        for key_hash, validated_at in validated_keys.items()
+        if isinstance(validated_at, (int, float))
+        and 0 <= now - validated_at < TINIFY_KEY_TTL
+    }
+
+
+def is_tinify_key_validated(api_key: str) -> bool:
+    """
+    Check if a Tinify API key was successfully validated in the last
+    :attr:`TINIFY_KEY_TTL` seconds
+
+    Args:
+        api_key (str): Tinify API key
+
+    Returns:
+        bool: True if the key doesn't need to be validated again
+    """
+    return _hash_tinify_key(api_key) in _load_tinify_keys()
+
+
+def save_tinify_key_validated(api_key: str) -> None:
+    """
+    Remember that a Tinify API key was successfully validated.
+    Failing to write the cache file is ignored, the key will just be validated again.
+
+    Args:
+        api_key (str): Tinify API key
+    """
+    validated_keys = _load_tinify_keys()
+    validated_keys[_hash_tinify_key(api_key)] = time.time()
+    keys_file = _get_tinify_keys_file()
+    tmp_file = keys_file.with_name(f"{keys_file.name}.{os.getpid()}.tmp")
+    try:
+        keys_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(validated_keys, f)
+        os.replace(tmp_file, keys_file)
+    except OSError:
+        pass
+
+
+class ImageCache:
+    """
+    Persistent cache of optimized images, stored in a SQLite database.
+    Once it holds more than max_size bytes of images the oldest ones are evicted.
+    It can be shared between threads, any database error just disables the cache.
+    """
+
+    def __init__(self, path: Path = None, max_size: int = IMAGE_CACHE_MAX_SIZE) -> None:
+        """
+        Args:
+            path (Path, optional): Database file, default is "images.sqlite"
+                inside :func:`get_cache_dir`
+            max_size (int, optional): Maximum size in bytes of the cached images
+        """
+        self.path = path or Path(get_cache_dir(), "images.sqlite")
+        self.max_size = max_size
+        self._lock = Lock()
+        self._connection = None
+        self._disabled = False
+        self._size = 0
+
+    def __enter__(self) -> "ImageCache":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        """Open the database on first use, must be called holding the lock"""
+        if self._connection is None and not self._disabled:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                connection = sqlite3.connect(self.path, check_same_thread=False)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS opt (key TEXT PRIMARY KEY, data BLOB)"
+                )
+                (self._size,) = connection.execute(
+                    "SELECT COALESCE(SUM(LENGTH(data)), 0) FROM opt"
+                ).fetchone()
+                self._connection = connection
+            except (OSError, sqlite3.Error):
+                self._disabled = True
+        return self._connection
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Get an optimized image from the cache
+
+        Args:
+            key (str): Image key
+
+        Returns:
+            Optional[bytes]: Optimized image, None if it's not cached
+        """
+        with self._lock:
+            connection = self._connect()
+            if connection is None:
+                return None
+            try:
+                row = connection.execute(
+                    "SELECT data FROM opt WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error:
+                return None
+        return row[0] if row else None
+
+    def put(self, key: str, data: bytes) -> None:
+        """
+        Store an optimized image in the cache, evicting the oldest images
+        if the cache grows over its maximum size
+
+        Args:
+            key (str): Image key
+            data (bytes): Optimized image
+        """
+        with self._lock:
+            connection = self._connect()
+            if connection is None:
+                return
+            try:
+                with connection:
+                    row = connection.execute(
+                        "SELECT LENGTH(data) FROM opt WHERE key = ?", (key,)
+                    ).fetchone()
+                    # Replaced rows get a new rowid, rowids follow insertion order
+                    connection.execute(
+                        "INSERT OR REPLACE INTO opt (key, data) VALUES (?, ?)",
+                        (key, data),
+                    )
+                    self._size += len(data) - (row[0] if row else 0)
+                    while self._size > self.max_size:
+                        row = connection.execute(
+                            "SELECT rowid, LENGTH(data) FROM opt ORDER BY rowid LIMIT 1"
+                        ).fetchone()
+                        if row is None:
+                            self._size = 0
+                            break
+                        connection.execute("DELETE FROM opt WHERE rowid = ?", (row[0],))
+                        self._size -= row[1]
+            except sqlite3.Error:
+                pass
+
+    def close(self) -> None:
+        """Close the database"""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
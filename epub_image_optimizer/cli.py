@@ -1,8 +1,10 @@
 import logging
+import os
 import signal
+import stat
 import sys
-from concurrent.futures import ThreadPoolExecutor
-from glob import glob
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 from pathlib import Path
 from threading import Event
 from typing import Tuple
@@ -13,7 +15,16 @@ import tinify
 from click.exceptions import ClickException
 from rich.progress import BarColumn, Progress, TextColumn, TimeRemainingColumn
 
-from epub_image_optimizer.image_optimizer import optimize_epub
+from epub_image_optimizer.cache import (
+    ImageCache,
+    is_tinify_key_validated,
+    save_tinify_key_validated,
+)
+from epub_image_optimizer.image_optimizer import (
+    create_image_pool,
+    create_tinify_pool,
+    optimize_epub,
+)
 from epub_image_optimizer.progress_bar import OptimizeImageColumn
 
 DEFAULT_OUTPUT_FOLDER = "./epub_image_optimizer_output"
@@ -22,7 +33,7 @@ MIN_IMAGE_RESOLUTION = (1, 1)
 
 def validate_input_file(ctx, param, value) -> Path:
     """
-    Validate if input file is an epub file
+    Validate if input file is a readable epub file, checking the filesystem once
 
     Args:
         ctx ([type]): Click context
@@ -30,23 +41,42 @@ def validate_input_file(ctx, param, value) -> Path:
         value ([type]): Click parameter value
 
     Raises:
-        click.BadParameter: If input file is not an epub file
+        click.BadParameter: If input file doesn't exist, is not readable
+            or is not an epub file
 
     Returns:
         Path: Path to the input file
     """
     if not value:
         return
+    try:
+        input_stat = os.stat(value)
+    except FileNotFoundError:
+        raise click.BadParameter(
+            f'File "{click.format_filename(value)}" does not exist.', ctx, param
+        )
+    except OSError as e:
+        raise click.BadParameter(
+            f'File "{click.format_filename(value)}" can\'t be accessed: {e.strerror}.',
+            ctx,
+            param,
+        )
     # Check source file is epub
-    filename = click.format_filename(value, True)
-    if not filename.endswith(".epub"):
-        raise click.BadParameter(f'"{filename}" is not an epub file', ctx, param)
+    if not str(value).lower().endswith(".epub") or not stat.S_ISREG(input_stat.st_mode):
+        raise click.BadParameter(
+            f'"{click.format_filename(value, True)}" is not an epub file', ctx, param
+        )
+    if not os.access(value, os.R_OK):
+        raise click.BadParameter(
+            f'File "{click.format_filename(value)}" is not readable.', ctx, param
+        )
     return value
 
 
 def validate_tinify_api_key(ctx, param, value) -> str:
     """
-    Validates that the Tinify API key is valid
+    Validates that the Tinify API key is valid, keys validated in the last
+    24 hours are not validated again
 
     Args:
         ctx ([type]): Click context
@@ -62,9 +92,13 @@ def validate_tinify_api_key(ctx, param, value) -> str:
     # Validate Tinify API key
     if not value:
         return
+    tinify.key = value
+    if is_tinify_key_validated(value):
+        # Validated recently, save the round-trip to Tinify
+        return value
     try:
-        tinify.key = value
         tinify.validate()
+        save_tinify_key_validated(value)
         click.echo(
             "Validated Tinify API key, number of compressions done this month: {}, "
             "remaining compressions this month (if free mode): {}".format(
@@ -117,19 +151,20 @@ def validate_output_dir(unused_ctx, unused_param, value) -> Path:
 
     Raises:
         ClickException: If program fails to create output directory
+            or the directory is not writable
 
     Returns:
         Path: Output directory path
     """
-    output_folder = Path(value)
-    # Create folder
+    output_folder = Path(value).absolute()
+    # Create folder, mkdir already fails if the path exists and is not a folder
     try:
         output_folder.mkdir(parents=True, exist_ok=True)
     except Exception as e:
-        raise ClickException(
-            f"Can not create output folder {output_folder.absolute()}: {e}"
-        )
-    return output_folder.absolute()
+        raise ClickException(f"Can not create output folder {output_folder}: {e}")
+    if not os.access(output_folder, os.W_OK):
+        raise ClickException(f"Output folder {output_folder} is not writable")
+    return output_folder
 
 
 @click.command()
@@ -146,7 +181,8 @@ def validate_output_dir(unused_ctx, unused_param, value) -> Path:
     default=DEFAULT_OUTPUT_FOLDER,
     help="Output folder",
     callback=validate_output_dir,
-    type=click.Path(file_okay=False, writable=True),
+    metavar="DIRECTORY",
+    type=str,
 )
 @click.option(
     "--input-file",
@@ -154,7 +190,8 @@ def validate_output_dir(unused_ctx, unused_param, value) -> Path:
     required=False,
     help="Path to Epub Input file",
     callback=validate_input_file,
-    type=click.Path(exists=True, dir_okay=False, readable=True),
+    metavar="FILE",
+    type=str,
 )
 @click.option(
     "--max-image-resolution",
@@ -183,6 +220,20 @@ def validate_output_dir(unused_ctx, unused_param, value) -> Path:
     is_flag=True,
     help="If this flag is present images will preserve colors (not converted to BW)",
 )
+@click.option(
+    "--compression-level",
+    required=False,
+    default=None,
+    type=click.IntRange(0, 9),
+    help="Deflate level for the text files, "
+    "by default they keep the compression of the input epub",
+)
+@click.option(
+    "--cache",
+    is_flag=True,
+    help="Keep optimized images in the user cache folder and reuse them in later "
+    "runs, up to 256 MiB",
+)
 @click.option(
     "--workers",
     required=False,
@@ -208,6 +259,8 @@ def main(
     tinify_api_key: str,
     only_cover: bool,
     keep_color: bool,
+    compression_level: int,
+    cache: bool,
     workers: int,
     log_level: str,
     version: bool,
@@ -240,17 +293,25 @@ def main(
     )
     input_epubs = None
     if input_dir:
-        input_epubs = [Path(epub) for epub in glob(str(Path(input_dir, "*.epub")))]
+        # DirEntry caches the file type, so filtering doesn't stat every file again
+        with os.scandir(Path(input_dir).absolute()) as entries:
+            input_epubs = sorted(
+                Path(entry.path)
+                for entry in entries
+                if entry.name.lower().endswith(".epub")
+                and not entry.name.startswith(".")
+                and entry.is_file()
+            )
     else:
-        input_epubs = [Path(input_file)]
+        input_epubs = [Path(input_file).absolute()]
     if not input_epubs:
         # TODO better exception handling overall
         raise Exception(f"No epubs found in input-dir {input_dir}")
 
     done_event = Event()
 
-    def handle_sigint():
-        """Handle SIGINT signal"""
+    def handle_sigint(unused_signum, unused_frame):
+        """Handle SIGINT signal, pending images are cancelled"""
         done_event.set()
 
     signal.signal(signal.SIGINT, handle_sigint)
@@ -264,7 +325,16 @@ def main(
         TimeRemainingColumn(),
     )
     click.echo(f"Optimizing {len(input_epubs)} epubs to {output_dir.absolute()}")
-    with progress, ThreadPoolExecutor(max_workers=workers) as pool:
+    # Once the Tinify monthly limit is reached no epub of this run uses it again
+    tinify_limit_reached = Event()
+    with ExitStack() as stack:
+        # The cache and the shared pools are closed last, once every epub is done
+        image_cache = stack.enter_context(ImageCache()) if cache else None
+        image_pool = stack.enter_context(create_image_pool())
+        tinify_pool = stack.enter_context(create_tinify_pool())
+        stack.enter_context(progress)
+        pool = stack.enter_context(ThreadPoolExecutor(max_workers=workers))
+        futures = {}
         for input_epub in input_epubs:
             # Create a logger object.
             epub_log = logging.getLogger(input_epub.name)
@@ -273,23 +343,38 @@ def main(
                 level=log_level,
                 logger=epub_log,
             )
+            log.debug("Optimizing EPUB file %s", input_epub)
+            task_id = progress.add_task(
+                "optimize", filename=input_epub.name, start=False
+            )
+            future = pool.submit(
+                optimize_epub,
+                input_epub,
+                output_dir,
+                only_cover,
+                keep_color,
+                epub_log,
+                progress,
+                task_id,
+                done_event,
+                max_image_resolution,
+                tinify_api_key,
+                image_pool,
+                image_cache,
+                compression_level,
+                tinify_pool,
+                tinify_limit_reached,
+            )
+            futures[future] = input_epub
+        # Epubs are optimized concurrently, report failures as they finish
+        failed_epubs = 0
+        for future in as_completed(futures):
+            input_epub = futures[future]
             try:
-                log.debug("Optimizing EPUB file %s", input_epub.absolute())
-                task_id = progress.add_task(
-                    "optimize", filename=input_epub.name, start=False
-                )
-                pool.submit(
-                    optimize_epub,
-                    input_epub,
-                    output_dir,
-                    only_cover,
-                    keep_color,
-                    epub_log,
-                    progress,
-                    task_id,
-                    done_event,
-                    max_image_resolution,
-                    tinify_api_key,
-                )
+                future.result()
             except Exception as e:
+                failed_epubs += 1
                 log.exception("Error optimizing %s: %s", input_epub.name, e)
+    if failed_epubs:
+        # Let scripts know the run failed, once every resource is closed
+        sys.exit(1)
@@ -1,18 +1,99 @@
-import datetime
+import hashlib
 import logging
+import multiprocessing
+import os
+import posixpath
 import re
+import shutil
+import signal
+import struct
+import sys
+import time
 import zipfile
-from io import BytesIO, StringIO
+from collections import OrderedDict
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack, nullcontext
+from io import BytesIO
 from pathlib import Path
-from threading import Event
-from typing import List, Tuple
+from threading import Event, Lock
+from typing import List, Optional, Tuple, Union
 
 import tinify
-from defusedxml.lxml import _etree, parse
+from lxml import etree
 from PIL import Image
 from rich.progress import Progress, TaskID
 
-IMAGE_PATTERN = r"([-\w]+\.(?:jpg|png|jpeg))"
+from epub_image_optimizer.cache import ImageCache
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+# Image modes that are already B&W, converting them to "L" gains nothing
+GRAYSCALE_MODES = ("1", "L", "LA")
+# Only used as a test, anchored so names like "image.jpg.bak" don't match
+IMAGE_PATTERN = re.compile(r"[-\w]+\.(?:jpg|png|jpeg)\Z", re.IGNORECASE)
+OPF_NAMESPACES = {"opf": "http://www.idpf.org/2007/opf"}
+# Epubs are untrusted input, never resolve entities or access the network
+OPF_PARSER = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=False)
+COVER_META_XPATH = etree.XPath(
+    "opf:metadata/*[@name='cover']/@content",
+    namespaces=OPF_NAMESPACES,
+    smart_strings=False,
+)
+MANIFEST_HREF_XPATH = etree.XPath(
+    "opf:manifest/opf:item[@id=$id]/@href",
+    namespaces=OPF_NAMESPACES,
+    smart_strings=False,
+)
+# cover.xhtml files are often not well-formed XML, the HTML parser copes with them
+COVER_XHTML_PARSER = etree.HTMLParser(no_network=True)
+COVER_IMG_XPATH = etree.XPath("//img/@src", smart_strings=False)
+IMAGE_WORKERS = (os.cpu_count() or 1) * 4
+# Tinify uploads are network bound, requests keeps up to 10 pooled connections
+TINIFY_WORKERS = 8
+COMPRESSION_LEVEL = 6
+# Already compressed formats, deflating them again only wastes CPU
+STORED_EXTENSIONS = (
+    # Images
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".gif",
+    ".webp",
+    # Fonts
+    ".woff",
+    ".woff2",
+    # Audio and video
+    ".mp3",
+    ".m4a",
+    ".mp4",
+    ".ogg",
+    ".webm",
+)
+COPY_BUFFER_SIZE = 1 << 20
+READ_BUFFER_SIZE = 1 << 20
+# Earliest timestamp a zip file can hold, used for reproducible outputs
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+# Latest timestamp a zip file can hold (2 second resolution)
+ZIP_MAX_DATE_TIME = (2107, 12, 31, 23, 59, 58)
+# Smaller images are not worth a Tinify request
+TINIFY_MIN_SIZE = 16 * 1024
+TINIFY_CACHE_SIZE = 128
+# HTTP status of the Tinify AccountError raised when the monthly limit is reached,
+# the other one (401) means the API key is not valid
+TINIFY_LIMIT_STATUS = 429
+# Bump it whenever the image processing changes, to invalidate the image cache
+IMAGE_CACHE_VERSION = 5
+# Tinify results by image digest, shared by all epubs so repeated images cost
+# a single request
+tinify_cache: "OrderedDict[bytes, bytes]" = OrderedDict()
+tinify_cache_lock = Lock()
 
 
 def get_opf(epub_zipfile: zipfile.ZipFile) -> str:
@@ -49,7 +130,7 @@ def get_cover_xhtml(epub_zipfile: zipfile.ZipFile) -> str:
     return None
 
 
-def get_images(epub_zipfile: zipfile.ZipFile) -> List[Path]:
+def get_images(epub_zipfile: zipfile.ZipFile) -> List[str]:
     """
     Find and return a list of all images inside the epub file
 
@@ -57,18 +138,187 @@ def get_images(epub_zipfile: zipfile.ZipFile) -> List[Path]:
         epub_zipfile (zipfile.ZipFile): Epub zipfile
 
     Returns:
-        List[Path]: List of paths of each image found
+        List[str]: List of paths of each image found
     """
-    images = []
-    for fname in epub_zipfile.namelist():
-        if re.findall(IMAGE_PATTERN, fname, re.IGNORECASE):
-            images.append(Path(fname).as_posix())
-    return images
+    return [
+        fname
+        for fname in epub_zipfile.namelist()
+        if fname.lower().endswith(IMAGE_EXTENSIONS)
+    ]
+
+
+def classify_entries(
+    epub_zipfile: zipfile.ZipFile,
+) -> Tuple[str, str, List[zipfile.ZipInfo], List[zipfile.ZipInfo]]:
+    """
+    Sort the entries of the epub file in a single pass over the archive,
+    same results as :func:`get_opf`, :func:`get_cover_xhtml` and :func:`get_images`
+
+    Args:
+        epub_zipfile (zipfile.ZipFile): Epub zipfile
+
+    Returns:
+        Tuple[str, str, List[zipfile.ZipInfo], List[zipfile.ZipInfo]]: Path of
+            the .opf file and path of the cover.xhtml file (None if not found),
+            image entries and every other entry, in archive order
+    """
+    opf_path = None
+    cover_xhtml_path = None
+    image_items = []
+    other_items = []
+    for item in epub_zipfile.infolist():
+        fname = item.filename
+        if fname.lower().endswith(IMAGE_EXTENSIONS):
+            image_items.append(item)
+            continue
+        if opf_path is None and fname.endswith(".opf"):
+            opf_path = fname
+        elif cover_xhtml_path is None and fname.endswith("cover.xhtml"):
+            cover_xhtml_path = fname
+        other_items.append(item)
+    return opf_path, cover_xhtml_path, image_items, other_items
+
+
+def get_zip_date_time() -> Tuple[int, int, int, int, int, int]:
+    """
+    Get the timestamp for the optimized images written to the output epub archive.
+    Uses SOURCE_DATE_EPOCH if set, otherwise a fixed date instead of the current time.
+
+    Returns:
+        Tuple[int, int, int, int, int, int]: Zip timestamp, :attr:`ZIP_EPOCH` by default
+            or if SOURCE_DATE_EPOCH is not a valid timestamp, clamped to the range
+            a zip file can hold
+    """
+    source_date_epoch = os.environ.get("SOURCE_DATE_EPOCH")
+    if not source_date_epoch:
+        return ZIP_EPOCH
+    try:
+        date_time = tuple(time.gmtime(int(source_date_epoch))[:6])
+    except (ValueError, OverflowError, OSError):
+        return ZIP_EPOCH
+    return min(max(date_time, ZIP_EPOCH), ZIP_MAX_DATE_TIME)
+
+
+def get_compress_type(fname: str) -> int:
+    """
+    Get the compression method to use for a file inside the output epub archive.
+    The "mimetype" file and already compressed images are stored as they are,
+    everything else is deflated.
+
+    Args:
+        fname (str): Path of the file inside the epub file
+
+    Returns:
+        int: zipfile compression constant
+    """
+    if fname == "mimetype" or fname.lower().endswith(STORED_EXTENSIONS):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def _copy_raw_zip_entry(
+    epub_zipfile: zipfile.ZipFile, item: zipfile.ZipInfo, outzip: zipfile.ZipFile
+) -> None:
+    """
+    Copies the compressed data of a file as is, without decompressing it.
+    zipfile has no public API for this, the entry is written the same way
+    ZipFile.write writes directories.
+
+    Args:
+        epub_zipfile (zipfile.ZipFile): Epub zipfile, not encrypted
+        item (zipfile.ZipInfo): File to copy
+        outzip (zipfile.ZipFile): Output epub zipfile
+
+    Raises:
+        AttributeError, TypeError: If the zipfile internals used here changed,
+            raised before anything is written to the output archive
+    """
+    zinfo = zipfile.ZipInfo(filename=item.filename, date_time=item.date_time)
+    zinfo.external_attr = item.external_attr
+    zinfo.compress_type = item.compress_type
+    zinfo.CRC = item.CRC
+    zinfo.compress_size = item.compress_size
+    zinfo.file_size = item.file_size
+    zip64 = max(item.file_size, item.compress_size) > zipfile.ZIP64_LIMIT
+    # Skip the local header of the source entry, its extra field can differ
+    # from the one in the central directory
+    src = epub_zipfile.fp
+    src.seek(item.header_offset)
+    fheader = struct.unpack(zipfile.structFileHeader, src.read(zipfile.sizeFileHeader))
+    if fheader[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad magic number for file header {item.filename}")
+    src.seek(fheader[10] + fheader[11], os.SEEK_CUR)
+    with outzip._lock:
+        if outzip._writing:
+            raise ValueError(
+                "Can't write to the ZIP file while there is an open writing handle"
+            )
+        outzip._writecheck(zinfo)
+        # Every internal is used before the first write, so a zipfile change
+        # can't leave a partial entry behind
+        file_header = zinfo.FileHeader(zip64)
+        zinfo.header_offset = outzip.fp.tell()
+        outzip._didModify = True
+        outzip.fp.write(file_header)
+        remaining = item.compress_size
+        while remaining:
+            chunk = src.read(min(remaining, COPY_BUFFER_SIZE))
+            if not chunk:
+                raise EOFError(f"Truncated file {item.filename}")
+            outzip.fp.write(chunk)
+            remaining -= len(chunk)
+        outzip.filelist.append(zinfo)
+        outzip.NameToInfo[zinfo.filename] = zinfo
+        outzip.start_dir = outzip.fp.tell()
+
+
+def copy_zip_entry(
+    epub_zipfile: zipfile.ZipFile,
+    item: zipfile.ZipInfo,
+    outzip: zipfile.ZipFile,
+    recompress: bool = False,
+) -> None:
+    """
+    Copies a file from the epub archive to the output archive.
+    Files already compressed the right way are copied without decompressing them,
+    the rest are recompressed in chunks, so the whole file is never loaded in memory.
+
+    Args:
+        epub_zipfile (zipfile.ZipFile): Epub zipfile
+        item (zipfile.ZipInfo): File to copy
+        outzip (zipfile.ZipFile): Output epub zipfile
+        recompress (bool, optional): if True, deflated files are always deflated
+            again, with the compression level of the output archive
+    """
+    compress_type = get_compress_type(item.filename)
+    # Bit 0 of the flags marks encrypted files
+    if (
+        item.compress_type == compress_type
+        and not item.flag_bits & 0x1
+        and not (recompress and compress_type == zipfile.ZIP_DEFLATED)
+    ):
+        try:
+            _copy_raw_zip_entry(epub_zipfile, item, outzip)
+            return
+        except (AttributeError, TypeError):
+            # zipfile internals changed, copy it with the public API instead
+            pass
+    zinfo = zipfile.ZipInfo(filename=item.filename, date_time=item.date_time)
+    zinfo.external_attr = item.external_attr
+    zinfo.compress_type = compress_type
+    # ZipFile.open ignores the archive compression level for a given ZipInfo
+    zinfo._compresslevel = outzip.compresslevel
+    zinfo.file_size = item.file_size
+    with epub_zipfile.open(item) as src, outzip.open(zinfo, "w") as dst:
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
 
 
 def find_cover_image(
-    opf_file: bytes, opf_folder: Path, epub_zipfile: zipfile.ZipFile
-) -> Path:
+    opf_file: bytes,
+    opf_folder: Path,
+    epub_zipfile: zipfile.ZipFile,
+    cover_xhtml_path: str = None,
+) -> str:
     """
     Searches for cover image inside the epub file.
     It has 3 different alternatives:
@@ -80,62 +330,280 @@ def find_cover_image(
         opf_file (bytes): content of the .opf file of the epub file
         opf_folder (Path): path where the .opf file is located inside the epub file
         epub_zipfile (zipfile.ZipFile): epub zipfile
+        cover_xhtml_path (str, optional): path of the 'cover.xhtml' file,
+            searched in the epub file if not given
 
     Returns:
-        Path: Cover image location
+        str: Cover image location
     """
-    root = _etree.fromstring(opf_file)
-    ns = {"opf": "http://www.idpf.org/2007/opf"}
+    # Zip entry names always use "/", plain strings are enough to join them.
+    # An .opf file at the root of the archive has no prefix
+    opf_prefix = opf_folder.as_posix()
+    opf_prefix = "" if opf_prefix in ("", ".") else f"{opf_prefix}/"
+
+    def resolve_href(href: str) -> str:
+        # Only relative segments like "../images" need to be normalized
+        if "./" in href:
+            return posixpath.normpath(opf_prefix + href)
+        return opf_prefix + href
+
+    root = etree.fromstring(opf_file, parser=OPF_PARSER)
+    # Method #1: Search metadata first, it holds the image path or the manifest
+    # item id of the cover
+    cover_contents = COVER_META_XPATH(root)
+    if cover_contents:
+        if IMAGE_PATTERN.search(cover_contents[0]) is not None:
+            return resolve_href(cover_contents[0])
+        image_hrefs = MANIFEST_HREF_XPATH(root, id=cover_contents[0])
+        if image_hrefs and IMAGE_PATTERN.search(image_hrefs[0]) is not None:
+            return resolve_href(image_hrefs[0])
+    # Cover not found in metadata, try alternative method #2
+    # Search in manifest if there is an item with the "cover-image" id
+    image_hrefs = MANIFEST_HREF_XPATH(root, id="cover-image")
+    if image_hrefs and IMAGE_PATTERN.search(image_hrefs[0]) is not None:
+        return resolve_href(image_hrefs[0])
+    # Cover not found in manifest, try alternative method #3
+    # Search in cover.xhtml file
+    if not cover_xhtml_path:
+        cover_xhtml_path = get_cover_xhtml(epub_zipfile)
+    if not cover_xhtml_path:
+        return None
     try:
-        # Method #1: Search metadata first
-        metadata = root.find("opf:metadata", ns)
-        cover_content = None
-        for item in list(metadata):
-            if item.get("name") == "cover":
-                cover_content = item.get("content")
-                break
-        regex = re.findall(IMAGE_PATTERN, cover_content, re.IGNORECASE)
-        if not regex:
-            manifest = root.find("opf:manifest", ns)
-            for item in list(manifest):
-                if item.get("id") == cover_content:
-                    image_href = item.get("href")
-                    regex = re.findall(IMAGE_PATTERN, image_href, re.IGNORECASE)
-                    if not regex:
-                        raise Exception
-                    return Path(opf_folder, image_href).as_posix()
-            raise Exception
-        return Path(opf_folder, cover_content).as_posix()
-    except Exception:
-        # Cover not found in metadata, try alternative method #2
-        # Search in manifest if there is an item with the "cover-image" id
+        with epub_zipfile.open(cover_xhtml_path, "r") as cover_xhtml_file:
+            cover_xhtml_root = etree.fromstring(
+                cover_xhtml_file.read(), parser=COVER_XHTML_PARSER
+            )
+    except (KeyError, zipfile.BadZipFile, etree.LxmlError):
+        return None
+    # Empty documents parse to None
+    if cover_xhtml_root is None:
+        return None
+    cover_images = COVER_IMG_XPATH(cover_xhtml_root)
+    if not cover_images:
+        return None
+    # The image is relative to cover.xhtml, not to the .opf file
+    cover_xhtml_folder = posixpath.dirname(cover_xhtml_path)
+    return posixpath.normpath(posixpath.join(cover_xhtml_folder, cover_images[0]))
+
+
+def _is_grayscale(image: Image.Image) -> bool:
+    """
+    Check if an image is already B&W, either by its mode or by a palette
+    with only gray colors
+
+    Args:
+        image (Image.Image): Opened image
+
+    Returns:
+        bool: True if the image doesn't need to be converted to B&W
+    """
+    if image.mode in GRAYSCALE_MODES:
+        return True
+    if image.mode == "P":
+        palette = image.getpalette()
+        return bool(palette) and palette[0::3] == palette[1::3] == palette[2::3]
+    return False
+
+
+def _init_image_worker() -> None:
+    """Image worker processes ignore SIGINT, the main process cancels pending images"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class ImagePool(Executor):
+    """
+    Executor to resize and convert images, shared by all the epubs being optimized.
+    Image encoding is CPU bound and holds the GIL for a good part of it, so a
+    process pool is used, falling back to threads if processes can't be used or
+    once the process pool is broken (e.g. a worker was killed, or spawned workers
+    can't import the main module). A broken pool would fail every later image.
+
+    Args:
+        max_workers (int, optional): Number of workers, default is the CPU count
+    """
+
+    def __init__(self, max_workers: int = None):
+        self._max_workers = max_workers
+        self._lock = Lock()
         try:
-            manifest = root.find("opf:manifest", ns)
-            for item in list(manifest):
-                if item.get("id") == "cover-image":
-                    image_href = item.get("href")
-                    regex = re.findall(IMAGE_PATTERN, image_href, re.IGNORECASE)
-                    if not regex:
-                        raise Exception
-                    return Path(opf_folder, image_href).as_posix()
-            raise Exception
-        except Exception:
-            # Cover not found in manifest, try alternative method #3
-            # Search in cover.xhtml file
+            self._executor = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_image_worker,
+            )
+        except (ImportError, NotImplementedError, OSError):
+            self._executor = self._create_thread_pool()
+        self._executors = [self._executor]
+        # Not done futures, cancel_futures of Executor.shutdown needs Python 3.9
+        self._futures = set()
+
+    def _create_thread_pool(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(max_workers=self._max_workers or IMAGE_WORKERS)
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        with self._lock:
             try:
-                cover_xhtml_path = get_cover_xhtml(epub_zipfile)
-                if not cover_xhtml_path:
-                    return None
-                with epub_zipfile.open(cover_xhtml_path, "r") as cover_xhtml_file:
-                    cover_xhtml_content = cover_xhtml_file.read()
-                    root = parse(
-                        StringIO(str(cover_xhtml_content)), parser=_etree.HTMLParser()
-                    )
-                    cover_image = root.xpath("//img/@src")[0]
-                    return Path(opf_folder, cover_image).as_posix()
-            except Exception:
-                pass
-    return None
+                future = self._executor.submit(fn, *args, **kwargs)
+            except BrokenProcessPool:
+                self._executor = self._create_thread_pool()
+                self._executors.append(self._executor)
+                future = self._executor.submit(fn, *args, **kwargs)
+            self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+        return future
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        with self._lock:
+            executors = list(self._executors)
+            futures = list(self._futures)
+        shutdown_kwargs = {}
+        if cancel_futures:
+            if sys.version_info >= (3, 9):
+                shutdown_kwargs["cancel_futures"] = True
+            else:
+                for future in futures:
+                    future.cancel()
+        for executor in executors:
+            executor.shutdown(wait=wait, **shutdown_kwargs)
+
+
+def create_image_pool(max_workers: int = None) -> Executor:
+    """
+    Create the executor used to resize and convert images, see :class:`ImagePool`
+
+    Args:
+        max_workers (int, optional): Number of workers, default is the CPU count
+
+    Returns:
+        Executor: Executor to pass to :func:`optimize_epub`
+    """
+    return ImagePool(max_workers)
+
+
+def create_tinify_pool() -> Executor:
+    """
+    Create the executor used to upload images to Tinify.
+    Sharing it between epubs bounds the concurrent Tinify requests to
+    :attr:`TINIFY_WORKERS` no matter how many epubs are optimized at once.
+
+    Returns:
+        Executor: Executor to pass to :func:`optimize_epub`
+    """
+    return ThreadPoolExecutor(max_workers=TINIFY_WORKERS, thread_name_prefix="tinify")
+
+
+def _optimize_image(
+    image_path: str,
+    image_data: bytes,
+    keep_color: bool,
+    max_image_resolution: Tuple[int, int] = None,
+) -> Tuple[str, Union[bytes, BytesIO]]:
+    """
+    Optimizes a single image, safe to run concurrently (in threads or processes)
+    as it doesn't touch any zipfile.
+    Images that don't need to be resized or converted keep their original content.
+
+    Args:
+        image_path (str): Path of the image inside the epub file
+        image_data (bytes): Content of the image
+        keep_color (bool): if True, don't transform image to B&W
+        max_image_resolution (Tuple[int, int], optional): Fit image to this resolution if bigger.
+
+    Returns:
+        Tuple[str, Union[bytes, BytesIO]]: Path of the image inside the epub file
+            and optimized content, the original content if it wasn't changed
+    """
+    # Opening only reads the header, pixels are decoded once something needs them
+    with Image.open(BytesIO(image_data)) as image:
+        image_format = image.format
+        fits = not max_image_resolution or (
+            image.width <= max_image_resolution[0]
+            and image.height <= max_image_resolution[1]
+        )
+        if fits and (keep_color or _is_grayscale(image)):
+            # Nothing to do, the image isn't re-encoded
+            return image_path, image_data
+        if image_format == "JPEG":
+            # Let libjpeg downscale and drop the color while decoding, instead of
+            # decoding the full size color image
+            image.draft("RGB" if keep_color else "L", max_image_resolution)
+        if max_image_resolution:
+            image.thumbnail(
+                max_image_resolution, Image.Resampling.LANCZOS, reducing_gap=2.0
+            )
+        if not keep_color and not _is_grayscale(image):
+            image = image.convert("L")
+        result_data = BytesIO()
+        # Smaller files for the same quality: optimized Huffman tables for JPEG, best
+        # zlib compression for PNG (other formats ignore it). Baseline JPEGs are kept
+        # as progressive ones are slow to decode on e-ink readers
+        image.save(result_data, format=image_format, optimize=True)
+    # BytesIO can be pickled, and on threads it's not copied at all
+    return image_path, result_data
+
+
+def _tinify_image(
+    image_data: Union[bytes, memoryview], limit_reached: Event
+) -> Union[bytes, memoryview]:
+    """
+    Compresses a single image with Tinify, :attr:`tinify.key` must be already set.
+    Images smaller than :attr:`TINIFY_MIN_SIZE` or processed after the Tinify
+    monthly limit is reached are returned untouched.
+
+    Args:
+        image_data (Union[bytes, memoryview]): Content of the image
+        limit_reached (Event): Set once Tinify refuses a compression because
+            the monthly limit is reached
+
+    Raises:
+        tinify.AccountError: If Tinify rejects the request because of the account
+
+    Returns:
+        Union[bytes, memoryview]: Compressed content of the image
+    """
+    if limit_reached.is_set() or len(image_data) < TINIFY_MIN_SIZE:
+        return image_data
+    digest = hashlib.blake2b(image_data, digest_size=16).digest()
+    with tinify_cache_lock:
+        if digest in tinify_cache:
+            tinify_cache.move_to_end(digest)
+            return tinify_cache[digest]
+    try:
+        result_data = tinify.from_buffer(bytes(image_data)).to_buffer()
+    except tinify.AccountError as e:
+        if e.status == TINIFY_LIMIT_STATUS:
+            limit_reached.set()
+        raise
+    with tinify_cache_lock:
+        tinify_cache[digest] = result_data
+        if len(tinify_cache) > TINIFY_CACHE_SIZE:
+            tinify_cache.popitem(last=False)
+    return result_data
+
+
+def get_image_cache_key(
+    image_data: bytes,
+    keep_color: bool,
+    max_image_resolution: Optional[Tuple[int, int]],
+    use_tinify: bool,
+) -> str:
+    """
+    Key of an image in the :class:`ImageCache`, a digest of its content
+    and of every option affecting how it's optimized
+
+    Args:
+        image_data (bytes): Content of the original image
+        keep_color (bool): if True, images are not transformed to B&W
+        max_image_resolution (Optional[Tuple[int, int]]): Maximum image resolution
+        use_tinify (bool): if True, images are compressed with Tinify
+
+    Returns:
+        str: Cache key
+    """
+    digest = hashlib.blake2b(image_data, digest_size=16)
+    options = (IMAGE_CACHE_VERSION, keep_color, max_image_resolution, use_tinify)
+    digest.update(repr(options).encode())
+    return digest.hexdigest()
 
 
 def optimize_epub(
@@ -149,6 +617,11 @@ def optimize_epub(
     done_event: Event,
     max_image_resolution: Tuple[int, int] = None,
     tinify_api_key: str = None,
+    image_pool: Executor = None,
+    image_cache: ImageCache = None,
+    compression_level: int = None,
+    tinify_pool: Executor = None,
+    tinify_limit_reached: Event = None,
 ) -> Path:
     """
     Main method, optimizes images inside epub file
@@ -160,8 +633,23 @@ def optimize_epub(
         keep_color (bool): if True, don't transform images to B&W
         max_image_resolution (Tuple[int, int], optional): Fit images to this resolution if bigger.
         tinify_api_key (str, optional): API key for the Tinify image optimizing service.
+        image_pool (Executor, optional): Executor to resize and convert images,
+            see :func:`create_image_pool`. A new one is created if not given.
+            Images are optimized again if the pool breaks, an :class:`ImagePool`
+            goes on with threads while other executors fail the epub.
+        image_cache (ImageCache, optional): Cache of optimized images, images found
+            in it are not optimized again.
+        compression_level (int, optional): Deflate level (0-9) for every compressed
+            file. By default files keep the compression of the input epub, and
+            the ones compressed again use :attr:`COMPRESSION_LEVEL`.
+        tinify_pool (Executor, optional): Executor to upload images to Tinify,
+            see :func:`create_tinify_pool`. A new one is created if not given.
+        tinify_limit_reached (Event, optional): Set once the Tinify monthly limit
+            is reached, share it between the epubs of the same run. The remaining
+            images are stored without Tinify.
 
     Raises:
+        tinify.AccountError: If the Tinify API key is not valid
         Exception: If it can't optimize epub or if cover image is not found (if only_cover is True)
 
     Returns:
@@ -169,67 +657,240 @@ def optimize_epub(
     """
     src_epub = input_epub.absolute()
     dst_epub = Path(
-        output_dir, src_epub.name.replace(".epub", "_optimized.epub")
+        output_dir, f"{src_epub.stem}_optimized{src_epub.suffix}"
     ).absolute()
-
-    with zipfile.ZipFile(src_epub) as epub_zipfile, zipfile.ZipFile(
-        dst_epub, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9
-    ) as outzip:
-        images_to_optimize = []
-        if only_cover:
-            opf_file_path = get_opf(epub_zipfile)
-            if not opf_file_path:
-                # TODO do something if not opf found
-                log.warn("OPF file not found")
-            opf_folder = Path(opf_file_path).parent
-            cover_image_path = None
-            with epub_zipfile.open(opf_file_path, "r") as opf_file:
-                opf_content = opf_file.read()
-                cover_image_path = find_cover_image(
-                    opf_content, opf_folder, epub_zipfile
-                )
-            if not cover_image_path:
-                raise Exception(f"Cover image not found in EPUB {src_epub}")
-            images_to_optimize.append(cover_image_path)
-        else:
-            # Find all images inside epub
-            images_to_optimize += get_images(epub_zipfile)
-        if len(images_to_optimize) == 0:
-            raise Exception(f"No images found in EPUB {src_epub}")
-        for item in epub_zipfile.infolist():
-            if item.filename in images_to_optimize:
-                continue
-            buffer = epub_zipfile.read(item.filename)
-            outzip.writestr(item.filename, buffer)
-        # Setup progress bar
-        progress.update(task_id, total=int(len(images_to_optimize)))
+    if (
+        keep_color
+        and not max_image_resolution
+        and not tinify_api_key
+        and compression_level is None
+        and not only_cover
+    ):
+        # No image would change, the optimized epub is a plain copy. Epubs
+        # without images still fail, as they do when images are optimized
+        with zipfile.ZipFile(src_epub) as epub_zipfile:
+            if not get_images(epub_zipfile):
+                raise Exception(f"No images found in EPUB {src_epub}")
+        log.info("Nothing to optimize, copying %s as it is", src_epub.name)
+        shutil.copyfile(src_epub, dst_epub)
+        progress.update(task_id, total=0)
         progress.start_task(task_id)
-        for image_path in images_to_optimize:
-            with epub_zipfile.open(image_path) as image_file:
-                ztext = image_file.read()
-                result_data = ztext
-                image = Image.open(BytesIO(ztext))
-                image_format = image.format
-                if max_image_resolution:
-                    image.thumbnail(max_image_resolution)
-                if not keep_color:
-                    image = image.convert("L")
-                result_data = BytesIO()
-                image.save(result_data, format=image_format)
-                result_data = result_data.getvalue()
-                if tinify_api_key:
-                    tinify.key = tinify_api_key
-                    try:
-                        result_data = tinify.from_buffer(result_data).to_buffer()
-                    except tinify.AccountError as e:
-                        log.exception(e)
-                        raise Exception(e.message)
-                cover_zipfile = zipfile.ZipInfo(
-                    filename=image_path, date_time=datetime.datetime.now().timetuple()
-                )
-                outzip.writestr(cover_zipfile, result_data)
-                log.debug("Optimized Image %s", image_path)
-                progress.update(task_id, advance=1)
-                if done_event.is_set():
-                    return dst_epub
         return dst_epub
+
+    # Images are resized/converted on one pool and then uploaded to Tinify on
+    # another one, results are written as they finish on this thread
+    with zipfile.ZipFile(
+        dst_epub,
+        "w",
+        compression=zipfile.ZIP_DEFLATED,
+        compresslevel=(
+            COMPRESSION_LEVEL if compression_level is None else compression_level
+        ),
+    ) as outzip, (
+        nullcontext(image_pool) if image_pool else create_image_pool()
+    ) as pool, (
+        nullcontext(tinify_pool) if tinify_pool else create_tinify_pool()
+    ) as tinify_executor:
+        date_time = get_zip_date_time()
+
+        def write_image(image_path: str, image_data: bytes) -> None:
+            image_zipinfo = zipfile.ZipInfo(filename=image_path, date_time=date_time)
+            image_zipinfo.compress_type = get_compress_type(image_path)
+            outzip.writestr(image_zipinfo, image_data)
+            progress.update(task_id, advance=1)
+
+        # The source is closed as soon as only images are left to write, not
+        # kept open while Pillow and Tinify work. A big read buffer serves most
+        # entries from memory instead of one read per entry
+        with ExitStack() as source_stack:
+            src_file = source_stack.enter_context(
+                open(src_epub, "rb", buffering=READ_BUFFER_SIZE)
+            )
+            epub_zipfile = source_stack.enter_context(zipfile.ZipFile(src_file))
+            opf_file_path, cover_xhtml_path, image_items, _ = classify_entries(
+                epub_zipfile
+            )
+            if only_cover:
+                if not opf_file_path:
+                    # TODO do something if not opf found
+                    log.warning("OPF file not found")
+                opf_folder = Path(opf_file_path).parent
+                cover_image_path = None
+                with epub_zipfile.open(opf_file_path, "r") as opf_file:
+                    opf_content = opf_file.read()
+                    cover_image_path = find_cover_image(
+                        opf_content, opf_folder, epub_zipfile, cover_xhtml_path
+                    )
+                if not cover_image_path:
+                    raise Exception(f"Cover image not found in EPUB {src_epub}")
+                log.debug("Cover image found at %s", cover_image_path)
+                # Every other image is copied as is
+                image_items = [
+                    item for item in image_items if item.filename == cover_image_path
+                ]
+            if not image_items:
+                raise Exception(f"No images found in EPUB {src_epub}")
+            # Setup progress bar
+            progress.update(task_id, total=len(image_items))
+            progress.start_task(task_id)
+            if tinify_api_key:
+                tinify.key = tinify_api_key
+            if tinify_limit_reached is None:
+                tinify_limit_reached = Event()
+            # Each image is read once, on this thread as ZipFile is not safe for
+            # concurrent reads, and handed over to the workers right away
+            pending = set()
+            cache_keys = {}
+            cached_futures = set()
+            # Inputs of the images on the pool, to submit them again if it breaks
+            image_inputs = {}
+            for item in image_items:
+                image_data = epub_zipfile.read(item)
+                if image_cache:
+                    cache_key = get_image_cache_key(
+                        image_data,
+                        keep_color,
+                        max_image_resolution,
+                        bool(tinify_api_key),
+                    )
+                    cached_data = image_cache.get(cache_key)
+                    if cached_data is not None:
+                        # Written in archive order with the other results, as
+                        # "mimetype" must be the first entry
+                        future = Future()
+                        future.set_result((item.filename, cached_data))
+                        cached_futures.add(future)
+                        pending.add(future)
+                        continue
+                    cache_keys[item.filename] = cache_key
+                if keep_color and not max_image_resolution:
+                    # Nothing for Pillow to do, skip the image pool
+                    future = Future()
+                    future.set_result((item.filename, image_data))
+                else:
+                    future = pool.submit(
+                        _optimize_image,
+                        item.filename,
+                        image_data,
+                        keep_color,
+                        max_image_resolution,
+                    )
+                    image_inputs[future] = (item.filename, image_data)
+                pending.add(future)
+            # Entries are written in the order of the source archive, images as
+            # soon as they and every entry before them are ready
+            entries = epub_zipfile.infolist()
+            image_names = frozenset(item.filename for item in image_items)
+            last_passthrough = max(
+                (
+                    i
+                    for i, item in enumerate(entries)
+                    if item.filename not in image_names
+                ),
+                default=-1,
+            )
+            results = {}
+            next_entry = 0
+
+            def write_ready_entries() -> None:
+                nonlocal next_entry
+                while next_entry < len(entries):
+                    item = entries[next_entry]
+                    if item.filename in image_names:
+                        if item.filename not in results:
+                            break
+                        write_image(item.filename, results.pop(item.filename))
+                    else:
+                        copy_zip_entry(
+                            epub_zipfile, item, outzip, compression_level is not None
+                        )
+                    next_entry += 1
+                if next_entry > last_passthrough:
+                    source_stack.close()
+
+            # Copy the files before the first image while the images are optimized
+            write_ready_entries()
+            tinify_inputs = {}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in tinify_inputs:
+                        image_path, result_data, changed = tinify_inputs.pop(future)
+                        try:
+                            tinified_data = future.result()
+                            # Skipped images are returned as they were given
+                            changed = changed or tinified_data is not result_data
+                            result_data = tinified_data
+                        except tinify.AccountError as e:
+                            if e.status != TINIFY_LIMIT_STATUS:
+                                for pending_future in pending:
+                                    pending_future.cancel()
+                                raise
+                            log.warning(
+                                "Tinify monthly limit reached, %s will not be "
+                                "compressed: %s",
+                                image_path,
+                                e.message,
+                            )
+                    else:
+                        image_input = image_inputs.pop(future, None)
+                        try:
+                            image_path, result_data = future.result()
+                        except BrokenProcessPool:
+                            # The next submit goes to threads, see ImagePool
+                            log.warning(
+                                "Image pool is broken, optimizing %s again",
+                                image_input[0],
+                            )
+                            try:
+                                retry_future = pool.submit(
+                                    _optimize_image,
+                                    *image_input,
+                                    keep_color,
+                                    max_image_resolution,
+                                )
+                            except BrokenProcessPool as e:
+                                for pending_future in pending:
+                                    pending_future.cancel()
+                                raise Exception(
+                                    f"Image pool is broken, can't optimize images "
+                                    f"of EPUB {src_epub}"
+                                ) from e
+                            image_inputs[retry_future] = image_input
+                            pending.add(retry_future)
+                            continue
+                        # Pillow returns the original bytes if it changed nothing
+                        changed = isinstance(result_data, BytesIO)
+                        if changed:
+                            # Zero-copy view, ZipFile.writestr accepts it as is
+                            result_data = result_data.getbuffer()
+                        if tinify_api_key and future not in cached_futures:
+                            tinify_future = tinify_executor.submit(
+                                _tinify_image, result_data, tinify_limit_reached
+                            )
+                            tinify_inputs[tinify_future] = (
+                                image_path,
+                                result_data,
+                                changed,
+                            )
+                            pending.add(tinify_future)
+                            continue
+                    results[image_path] = result_data
+                    if future in cached_futures:
+                        log.debug("Cached Image %s", image_path)
+                    else:
+                        log.debug("Optimized Image %s", image_path)
+                    # Unchanged images and images Tinify failed to compress are not
+                    # cached
+                    if (
+                        image_path in cache_keys
+                        and changed
+                        and not (tinify_api_key and tinify_limit_reached.is_set())
+                    ):
+                        image_cache.put(cache_keys[image_path], result_data)
+                    if done_event.is_set():
+                        for pending_future in pending:
+                            pending_future.cancel()
+                        return dst_epub
+                write_ready_entries()
+    return dst_epub
@@ -1,10 +1,21 @@
 import os
+import time
+import zipfile
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 
+import pytest
+import tinify
 from click.testing import CliRunner
 
-from epub_image_optimizer import __version__
+from epub_image_optimizer import __version__, image_optimizer
+from epub_image_optimizer.cache import save_tinify_key_validated
 from epub_image_optimizer.cli import main
+from epub_image_optimizer.image_optimizer import (
+    create_image_pool,
+    get_compress_type,
+    get_zip_date_time,
+)
 
 TEST_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
 TEST_EPUB = Path(TEST_DIR, "moby-dick.epub")
@@ -20,12 +31,22 @@ BAD_MAX_IMAGE_RES_COMMAND_1 = BASE_COMMAND_FILE + ["--max-image-resolution", "1"
 BAD_MAX_IMAGE_RES_COMMAND_2 = BASE_COMMAND_FILE + ["--max-image-resolution", "0", "1"]
 BAD_MAX_IMAGE_RES_COMMAND_3 = BASE_COMMAND_FILE + ["--max-image-resolution", "0", "0"]
 BAD_INPUT_FILE_NOTEXISTS_COMMAND = ["--input-file", "idontexist"]
+BAD_INPUT_FILE_NOT_DIR_COMMAND = ["--input-file", Path(TEST_EPUB, "book.epub")]
 BAD_INPUT_FILE_NOT_EPUB_COMMAND = ["--input-file", TEST_BAD_EPUB]
+COMPRESSION_LEVEL_COMMAND = BASE_COMMAND_FILE + ["--compression-level", "9"]
+BAD_COMPRESSION_LEVEL_COMMAND = BASE_COMMAND_FILE + ["--compression-level", "10"]
 BAD_INPUT_FOLDER_COMMAND = ["--input-dir", TEST_BAD_FOLDER]
 
 runner = CliRunner()
 
 
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    """Keep the cache files out of the user cache folder"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    return tmp_path
+
+
 def test_version_cli():
     """Test the version command"""
     result = runner.invoke(main, VERSION_COMMAND)
@@ -51,6 +72,40 @@ def test_bad_tinify_key():
     assert result.exit_code == 2
 
 
+def test_cached_tinify_key():
+    """Test recently validated tinify key is not validated again"""
+    save_tinify_key_validated("dawdwada")
+    result = runner.invoke(main, BAD_TINIFY_COMMAND + VERSION_COMMAND)
+    assert result.exit_code == 0
+
+
+def test_tinify_limit_reached(tmp_path, monkeypatch):
+    """Test images are stored without Tinify once the monthly limit is reached"""
+
+    def from_buffer(image_data):
+        raise tinify.AccountError("Monthly limit reached", "TooManyRequests", 429)
+
+    monkeypatch.setattr(tinify, "from_buffer", from_buffer)
+    save_tinify_key_validated("dawdwada")
+    result = runner.invoke(main, BAD_TINIFY_COMMAND + ["--output-dir", tmp_path])
+    assert result.exit_code == 0
+    assert "Tinify monthly limit reached" in result.output
+    assert Path(tmp_path, "moby-dick_optimized.epub").is_file()
+
+
+def test_tinify_bad_credentials(tmp_path, monkeypatch):
+    """Test epub fails if Tinify rejects the API key"""
+
+    def from_buffer(image_data):
+        raise tinify.AccountError("Credentials are invalid", "Unauthorized", 401)
+
+    monkeypatch.setattr(tinify, "from_buffer", from_buffer)
+    save_tinify_key_validated("dawdwada")
+    result = runner.invoke(main, BAD_TINIFY_COMMAND + ["--output-dir", tmp_path])
+    assert result.exit_code == 1
+    assert "Error optimizing moby-dick.epub" in result.output
+
+
 def test_bad_max_image_res():
     """Test error while bad max image resolution is used"""
     result = runner.invoke(main, BAD_MAX_IMAGE_RES_COMMAND_1)
@@ -61,6 +116,13 @@ def test_bad_max_image_res():
     assert result.exit_code == 2
 
 
+def test_bad_input_file_not_dir():
+    """Test error while input file path goes through a file"""
+    result = runner.invoke(main, BAD_INPUT_FILE_NOT_DIR_COMMAND)
+    assert result.exit_code == 2
+    assert "can't be accessed: Not a directory" in result.output
+
+
 def test_bad_input_file_not_exists():
     """Test error while non-existing input file is given"""
     result = runner.invoke(main, BAD_INPUT_FILE_NOTEXISTS_COMMAND)
@@ -75,6 +137,15 @@ def test_bad_input_file_not_epub():
     assert result.output.__contains__("not an epub file")
 
 
+def test_bad_input_file_epub_not_extension(tmp_path):
+    """Test error while input file has .epub in its name but not as extension"""
+    bad_epub = Path(tmp_path, "moby-dick.epub.bak")
+    bad_epub.touch()
+    result = runner.invoke(main, ["--input-file", bad_epub])
+    assert result.exit_code == 2
+    assert result.output.__contains__("not an epub file")
+
+
 def test_bad_input_folder():
     """Test error while non-existing input folder is given"""
     result = runner.invoke(main, BAD_INPUT_FOLDER_COMMAND)
@@ -88,6 +159,97 @@ def test_valid_input_file():
     assert result.exit_code == 0
 
 
+def test_cached_images(cache_home):
+    """Test optimized images are cached and reused"""
+    output_dir = Path(cache_home, "output")
+    command = BASE_COMMAND_FILE + ["--output-dir", output_dir, "--cache"]
+    result = runner.invoke(main, command)
+    assert result.exit_code == 0
+    assert Path(cache_home, "epub_image_optimizer", "images.sqlite").is_file()
+    result = runner.invoke(main, command + ["--log-level", "DEBUG"])
+    assert result.exit_code == 0
+    assert "Cached Image OPS/images/9780316000000.jpg" in result.output
+    # Already B&W, it's copied as is and not cached
+    assert "Optimized Image OPS/images/Moby-Dick_FE_title_page.jpg" in result.output
+    # Cached images are still written after "mimetype"
+    with zipfile.ZipFile(Path(output_dir, "moby-dick_optimized.epub")) as epub:
+        first_entry = epub.infolist()[0]
+    assert first_entry.filename == "mimetype"
+    assert first_entry.compress_type == zipfile.ZIP_STORED
+
+
+def test_compression_level():
+    """Test compression level option"""
+    result = runner.invoke(main, COMPRESSION_LEVEL_COMMAND)
+    assert result.exit_code == 0
+    result = runner.invoke(main, BAD_COMPRESSION_LEVEL_COMMAND)
+    assert result.exit_code == 2
+
+
+@pytest.mark.parametrize("raw_copy", [True, False])
+def test_output_epub(tmp_path, monkeypatch, raw_copy):
+    """Test optimized epub is a valid archive with the entries of the input epub,
+    also when files can't be copied without decompressing them"""
+    if not raw_copy:
+
+        def copy_raw_zip_entry(epub_zipfile, item, outzip):
+            raise AttributeError("'ZipFile' object has no attribute '_writecheck'")
+
+        monkeypatch.setattr(image_optimizer, "_copy_raw_zip_entry", copy_raw_zip_entry)
+    result = runner.invoke(main, BASE_COMMAND_FILE + ["--output-dir", tmp_path])
+    assert result.exit_code == 0
+    with zipfile.ZipFile(TEST_EPUB) as input_epub:
+        input_names = input_epub.namelist()
+    with zipfile.ZipFile(Path(tmp_path, "moby-dick_optimized.epub")) as output_epub:
+        assert output_epub.testzip() is None
+        assert output_epub.namelist() == input_names
+        for item in output_epub.infolist():
+            assert item.compress_type == get_compress_type(item.filename)
+
+
+def test_broken_image_pool():
+    """Test image pool goes on with threads once a worker process dies"""
+    with create_image_pool(1) as pool:
+        assert isinstance(pool.submit(os._exit, 1).exception(), BrokenProcessPool)
+        assert pool.submit(pow, 2, 3).result() == 8
+
+
+def test_image_pool_cancel_futures():
+    """Test image pool shutdown cancels the images not started yet"""
+    pool = create_image_pool(1)
+    futures = [pool.submit(time.sleep, 0.2) for _ in range(5)]
+    pool.shutdown(cancel_futures=True)
+    assert futures[-1].cancelled()
+
+
+@pytest.mark.parametrize(
+    "source_date_epoch,date_time",
+    [
+        ("not a date", (1980, 1, 1, 0, 0, 0)),
+        ("1e99", (1980, 1, 1, 0, 0, 0)),
+        ("-1", (1980, 1, 1, 0, 0, 0)),
+        # 2200-01-01, after the latest zip timestamp
+        ("7258118400", (2107, 12, 31, 23, 59, 58)),
+    ],
+)
+def test_bad_source_date_epoch(tmp_path, monkeypatch, source_date_epoch, date_time):
+    """Test invalid or out of range SOURCE_DATE_EPOCH gives a valid zip timestamp"""
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", source_date_epoch)
+    assert get_zip_date_time() == date_time
+    result = runner.invoke(main, BASE_COMMAND_FILE + ["--output-dir", tmp_path])
+    assert result.exit_code == 0
+
+
+def test_nothing_to_optimize(tmp_path):
+    """Test epub is copied as is when no option changes the images"""
+    result = runner.invoke(
+        main, BASE_COMMAND_FILE + ["--keep-color", "--output-dir", tmp_path]
+    )
+    assert result.exit_code == 0
+    output_epub = Path(tmp_path, "moby-dick_optimized.epub")
+    assert output_epub.read_bytes() == TEST_EPUB.read_bytes()
+
+
 def test_valid_input_folder():
     """Test valid input folder"""
     result = runner.invoke(main, BASE_COMMAND_FOLDER)